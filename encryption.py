@@ -74,7 +74,114 @@ cipher_mode = CTR
 
 In absence of a strong reason, we recommend going with the defaults of AES and
 CTR.  CTR allows Swift's range requests to be efficient even on encrypted
-data.
+data: a GET for a single byte range is decrypted by starting the keystream at
+the range's offset.  A multi-range GET, or any range GET with another mode,
+has its ``Range`` header removed and is served the whole object.
+
+Bulk archive extraction: Swift's ``bulk`` middleware turns an
+``extract-archive`` PUT into one object PUT per archive member; ``bulk`` must
+sit to the left of ``encryption`` in the pipeline, so that only the members
+(never the archive itself) reach ``encryption``.  Those member
+PUTs share the parent's ``swift.trans_id`` and are tagged with a
+``swift.source`` of ``EA``, and ``encryption`` treats each transaction as a
+batch.  If the key-management middleware also provides a
+``batch_secret_generator`` in ``encryption_params``, it is called once per
+batch (with the first member's request) and must return a callable which,
+given a member request, returns that member's secrets just as
+``secret_generator`` would -- typically without another round trip to the key
+store.  Without ``batch_secret_generator``, every member falls back to
+``secret_generator``.  Member bodies are encrypted as they are read, so no
+archive member is buffered in full.  Two optional parameters tune the batch
+cache:
+
+  bulk_batch_ttl = 300      (seconds a batch stays cached after its last use)
+  bulk_max_batches = 1024   (concurrent batches cached per proxy worker)
+
+Admission control: each proxy worker can cap the crypto work it has in
+flight.  Every encrypted GET or PUT holds one cipher stream until its response
+body is closed.  It also holds a nominal reservation of buffer bytes: the
+object (PUT) or range (GET) size if known, capped at ``crypto_chunk_size``,
+which is the most the middleware buffers for a stream at once.  Actual bytes
+buffered are not measured, so ``max_crypto_bytes`` limits the sum of these
+reservations.  It is stricter than ``max_cipher_streams`` alone only when
+requests smaller than ``crypto_chunk_size`` are common.  A request that would
+exceed the budget is rejected with ``503 Service Unavailable`` and a
+``Retry-After`` header rather than queued.  Small requests (a PUT with a known
+length, or a GET for a single range, of at most ``small_request_size`` bytes)
+may use every stream; the last ``reserved_small_streams`` streams are withheld
+from everything else, so long uploads and downloads cannot starve them.  Zero
+disables a limit:
+
+  max_crypto_bytes = 0
+  max_cipher_streams = 0
+  reserved_small_streams = 0
+  small_request_size = 1048576
+  crypto_chunk_size = 65536
+  shed_retry_after = 1
+
+A non-zero ``max_crypto_bytes`` smaller than ``crypto_chunk_size`` would shed
+every request of unknown size, so it is rejected at startup.
+
+Budget usage is reported through the proxy logger's StatsD client.  Each time
+a worker makes or releases a reservation it sends its current stream count and
+reserved bytes, as absolute values, as the timer samples
+``encryption.budget.streams`` and ``encryption.budget.bytes``.  Each StatsD
+flush therefore reports the peak (``upper``) and mean per-worker usage for
+that interval.  No value depends on earlier samples, so lost packets or
+restarted workers do not skew later values.  ``encryption.budget.shed`` counts
+rejected requests.
+
+Parallel segment uploads: segments of a large object may be uploaded
+concurrently, through any proxy, without sharing a ``(key, iv)`` pair.  A
+client marks a segment PUT with two headers:
+
+  X-Encryption-Segment-Of: <container>/<manifest object>
+  X-Encryption-Segment-Index: <segment number, starting at 0>
+
+``encryption`` then derives a key and IV for the segment from the secrets
+returned by the key-management middleware, the segment's own path, the
+manifest's /account/container/object path and the segment index (HKDF-style
+expansion using HMAC-SHA256), so no two segments share a keystream, even
+under a key manager which hands every object the same secrets.  The two
+values are stored as object sysmeta; on GET they are read back from the
+object's response headers and the same key and IV are derived again, so
+segments can be decrypted and reassembled by SLO on any proxy with no shared
+state.
+
+Existing plaintext objects: every object PUT through ``encryption`` is tagged
+with ``X-Object-Sysmeta-Encryption`` (``<cipher_name>/<cipher_mode>``).  A GET
+for an object without that marker is treated as legacy plaintext and passed
+through untouched, without consulting the key manager or building a cipher,
+so the middleware can be enabled on a cluster that already holds data.  A GET
+for an object whose marker names a different cipher or mode than the one
+configured fails with ``500 Internal Server Error`` rather than returning
+garbage.  Legacy objects may optionally be encrypted in place as they are
+read:
+
+  migrate_on_read = false
+  migrate_rate = 1            (migrations started per second per worker; 0
+                               disables migration)
+  migrate_max_size = 104857600
+  migrate_exclude_containers = *_segments
+
+When enabled, a full GET of a legacy object no larger than
+``migrate_max_size`` schedules a background re-read and re-PUT of that object
+through ``encryption``, subject to ``migrate_rate``.  Content type, user
+metadata and other middlewares' sysmeta are carried over, and the re-PUT
+carries the object's own timestamp plus the smallest increment Swift records,
+so it loses to (and is rejected by) any newer write made in the meantime.
+Outcomes are counted as ``encryption.migrate.success`` and
+``encryption.migrate.failure``.
+
+Migration changes an object's ETag: it becomes the MD5 of the stored
+ciphertext.  SLO and DLO manifests check their segments' ETags, so a
+migrated segment would make its manifest unreadable.  Manifests, segment
+reads made by SLO or DLO, and objects in containers matching any of the
+comma-separated shell-style patterns in ``migrate_exclude_containers`` are
+therefore never migrated.  ``encryption`` cannot tell from an object alone
+whether some manifest references it, so every container that holds legacy
+segments must match one of these patterns.  The default, ``*_segments``,
+covers swiftclient's naming convention.
 
 Caveats:
  * Encryption is CPU-intensive.  Adding this middleware to your pipeline will
@@ -82,17 +189,250 @@ Caveats:
 
  * You must use a key-management middleware component in your pipeline also.
 """
+import fnmatch
+import hashlib
+import hmac
 import time
 from itertools import chain, ifilter
+from eventlet import spawn_n
 from swift.common import swob, wsgi
 from swift.common.swob import wsgify
-from swift.common.utils import register_swift_info, get_logger
+from swift.common.utils import register_swift_info, get_logger, \
+    config_true_value, normalize_timestamp, FileLikeIter, list_from_csv
 from swift.proxy.controllers.base import get_container_info
 
 try:
     from Crypto import Cipher
+    from Crypto.Util import Counter
 except ImportError:
-    raise HTTPInternalServerError('pycrypto not installed on proxy server')
+    raise swob.HTTPInternalServerError(
+        'pycrypto not installed on proxy server')
+
+
+BULK_EXTRACT_SOURCE = 'EA'
+SEGMENT_OF_HEADER = 'X-Encryption-Segment-Of'
+SEGMENT_INDEX_HEADER = 'X-Encryption-Segment-Index'
+SYSMETA_SEGMENT_OF = 'X-Object-Sysmeta-Encryption-Segment-Of'
+SYSMETA_SEGMENT_INDEX = 'X-Object-Sysmeta-Encryption-Segment-Index'
+SYSMETA_ENCRYPTION = 'X-Object-Sysmeta-Encryption'
+MIGRATE_SOURCE = 'ENCM'
+# swift.source values of the segment reads made by SLO and DLO
+MANIFEST_SOURCES = ('SLO', 'DLO')
+# Object headers carried over when a legacy object is migrated
+MIGRATE_COPY_HEADERS = ('Content-Type', 'Content-Disposition',
+                        'Content-Encoding', 'X-Delete-At')
+
+
+def parse_secrets(secrets):
+    """
+    Split the value returned by a secret generator into ``(key, iv)``.
+
+    :param secrets: either a ``(key, iv)`` tuple or a bare key
+    :raises HTTPInternalServerError: on any other kind of value
+    """
+    if type(secrets) is tuple and len(secrets) == 2:
+        return secrets
+    elif type(secrets) is bytes:
+        return secrets, None
+    raise swob.HTTPInternalServerError(
+        'encryption: secrets() returned unexpected value')
+
+
+def close_if_possible(maybe_closable):
+    close_method = getattr(maybe_closable, 'close', None)
+    if callable(close_method):
+        return close_method()
+
+
+def derive_segment_secrets(key, iv, segment_path, manifest_path, index):
+    """
+    Derive a per-segment ``(key, iv)`` from an object's secrets.
+
+    The derived values have the same lengths as ``key`` and ``iv``, and are
+    a deterministic function of the segment's own path, the manifest path and
+    the segment index, so any proxy holding the same secrets derives the same
+    values, while objects that share secrets still get distinct keystreams.
+
+    :param key: key returned by the secret generator
+    :param iv: IV returned by the secret generator, or None
+    :param segment_path: /account/container/object of the segment itself
+    :param manifest_path: /account/container/object of the manifest
+    :param index: zero-based segment number
+    """
+    info = '%s\0%s\0%d' % (segment_path, manifest_path, index)
+
+    def expand(label, length):
+        output, block, counter = '', '', 1
+        while len(output) < length:
+            block = hmac.new(key, '%s%s\0%s%s' % (
+                block, label, info, chr(counter)), hashlib.sha256).digest()
+            output += block
+            counter += 1
+        return output[:length]
+
+    return expand('key', len(key)), (
+        expand('iv', len(iv)) if iv is not None else None)
+
+
+def segment_identity(headers, account, of_header, index_header):
+    """
+    Return ``(manifest_path, index)`` from segment headers, or None.
+
+    :raises HTTPBadRequest: if only one header is present, or the index is
+                            not a non-negative integer
+    """
+    manifest, index = headers.get(of_header), headers.get(index_header)
+    if manifest is None and index is None:
+        return None
+    try:
+        index = int(index)
+    except (TypeError, ValueError):
+        index = -1
+    if not manifest or index < 0:
+        raise swob.HTTPBadRequest(
+            '%s and %s must be given together, with a non-negative index'
+            % (SEGMENT_OF_HEADER, SEGMENT_INDEX_HEADER))
+    return '/%s/%s' % (account, manifest.lstrip('/')), index
+
+
+class EncryptingInput(object):
+    """File-like wrapper which encrypts ``wsgi.input`` as it is read."""
+
+    def __init__(self, wsgi_input, cipher):
+        self.wsgi_input = wsgi_input
+        self.cipher = cipher
+
+    def read(self, *args, **kwargs):
+        return self.cipher.encrypt(self.wsgi_input.read(*args, **kwargs))
+
+    def readline(self, *args, **kwargs):
+        return self.cipher.encrypt(self.wsgi_input.readline(*args, **kwargs))
+
+
+class DecryptingIter(object):
+    """Wrap a response body, decrypting each chunk as it is read."""
+
+    def __init__(self, app_iter, cipher):
+        self.app_iter = app_iter
+        self.cipher = cipher
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            yield self.cipher.decrypt(chunk)
+
+    def close(self):
+        close_if_possible(self.app_iter)
+
+
+class CryptoBudget(object):
+    """
+    Per-worker accounting of cipher streams and their nominal buffer bytes.
+
+    Proxy workers run requests in eventlet greenthreads, so plain counters
+    are safe without locking.
+    """
+
+    def __init__(self, max_bytes, max_streams, reserved_small_streams,
+                 logger):
+        self.max_bytes = max_bytes
+        self.max_streams = max_streams
+        self.reserved_small_streams = reserved_small_streams
+        self.logger = logger
+        self.bytes_in_flight = 0
+        self.streams = 0
+
+    def acquire(self, nbytes, small):
+        """
+        Try to reserve one stream and ``nbytes`` of buffer.
+
+        :returns: True if the reservation was made, False if it would exceed
+                  the budget
+        """
+        stream_limit = self.max_streams
+        if stream_limit and not small:
+            stream_limit = max(stream_limit - self.reserved_small_streams, 0)
+        if (self.max_streams and self.streams >= stream_limit) or \
+                (self.max_bytes and
+                 self.bytes_in_flight + nbytes > self.max_bytes):
+            self.logger.increment('budget.shed')
+            return False
+        self.streams += 1
+        self.bytes_in_flight += nbytes
+        self.report()
+        return True
+
+    def release(self, nbytes):
+        self.streams -= 1
+        self.bytes_in_flight -= nbytes
+        self.report()
+
+    def report(self):
+        """Send the current usage as StatsD timer samples."""
+        self.logger.timing('budget.streams', self.streams)
+        self.logger.timing('budget.bytes', self.bytes_in_flight)
+
+
+class ReleasingIter(object):
+    """Wrap a response body, calling ``release`` once when it is done."""
+
+    def __init__(self, app_iter, release):
+        self.app_iter = app_iter
+        self.release = release
+        self.released = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.app_iter:
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.released:
+            self.released = True
+            self.release()
+        close_if_possible(self.app_iter)
+
+
+class KeyBatchCache(object):
+    """
+    Per-transaction cache of member secret generators for bulk extraction.
+
+    Entries are keyed by ``swift.trans_id`` and expire ``ttl`` seconds after
+    their last use.  At most ``max_batches`` entries are kept; when full, the
+    entry closest to expiry is evicted.
+    """
+
+    def __init__(self, ttl, max_batches):
+        self.ttl = ttl
+        self.max_batches = max_batches
+        self._batches = {}  # trans_id -> [expiry, member_secrets]
+
+    def get(self, trans_id, now=None):
+        now = time.time() if now is None else now
+        entry = self._batches.get(trans_id)
+        if entry is None:
+            return None
+        if entry[0] < now:
+            del self._batches[trans_id]
+            return None
+        entry[0] = now + self.ttl
+        return entry[1]
+
+    def put(self, trans_id, member_secrets, now=None):
+        now = time.time() if now is None else now
+        if trans_id not in self._batches and \
+                len(self._batches) >= self.max_batches:
+            self._prune(now)
+        self._batches[trans_id] = [now + self.ttl, member_secrets]
+
+    def _prune(self, now):
+        for trans_id, entry in self._batches.items():
+            if entry[0] < now:
+                del self._batches[trans_id]
+        if len(self._batches) >= self.max_batches:
+            oldest = min(self._batches, key=lambda t: self._batches[t][0])
+            del self._batches[oldest]
 
 
 class EncryptionMiddleware(object):
@@ -109,13 +449,222 @@ class EncryptionMiddleware(object):
         self.cipher_modename = conf.get('cipher_mode', 'CTR')
 
         try:
-            module = __import__('Crypto.Cipher.%s' % self.cipher_name)
-            setattr('Cipher', self.cipher_name, module)
-            self.cipher_class = getattr(module, '%sCipher' % self.cipher_class)
-            self.cipher_mode = module.get('MODE_%s' % self.cipher_modename)
-        except ImportError:
-            raise HTTPInternalServerError('Failed to import Crypto.Cipher.%s'
-                                          % self.cipher_name)
+            self.cipher_class = __import__(
+                'Crypto.Cipher.%s' % self.cipher_name,
+                fromlist=[self.cipher_name])
+            self.cipher_mode = getattr(self.cipher_class,
+                                       'MODE_%s' % self.cipher_modename)
+        except (ImportError, AttributeError):
+            raise swob.HTTPInternalServerError(
+                'Failed to import Crypto.Cipher.%s.MODE_%s'
+                % (self.cipher_name, self.cipher_modename))
+
+        self.key_batches = KeyBatchCache(
+            float(conf.get('bulk_batch_ttl', 300)),
+            int(conf.get('bulk_max_batches', 1024)))
+        self.budget = CryptoBudget(
+            int(conf.get('max_crypto_bytes', 0)),
+            int(conf.get('max_cipher_streams', 0)),
+            int(conf.get('reserved_small_streams', 0)),
+            self.logger)
+        self.small_request_size = int(conf.get('small_request_size', 1048576))
+        self.crypto_chunk_size = int(conf.get('crypto_chunk_size', 65536))
+        if 0 < self.budget.max_bytes < self.crypto_chunk_size:
+            raise ValueError(
+                'max_crypto_bytes (%d) must be 0 or at least '
+                'crypto_chunk_size (%d)'
+                % (self.budget.max_bytes, self.crypto_chunk_size))
+        self.shed_retry_after = int(conf.get('shed_retry_after', 1))
+        self.marker = '%s/%s' % (self.cipher_name, self.cipher_modename)
+        migrate_rate = float(conf.get('migrate_rate', 1))
+        if migrate_rate < 0:
+            raise ValueError('migrate_rate must not be negative')
+        self.migrate_on_read = migrate_rate > 0 and config_true_value(
+            conf.get('migrate_on_read', 'false'))
+        self.migrate_interval = 1.0 / migrate_rate if migrate_rate else None
+        self.migrate_max_size = int(conf.get('migrate_max_size', 104857600))
+        self.migrate_exclude_containers = list_from_csv(
+            conf.get('migrate_exclude_containers', '*_segments'))
+        self.next_migration = 0
+        self.migrating = set()
+
+    def maybe_migrate(self, req, resp):
+        """
+        Schedule in-place encryption of the legacy object behind ``resp``.
+
+        Only full GETs of plain objects within ``migrate_max_size`` qualify,
+        and at most one migration starts every ``migrate_interval`` seconds.
+        Possible manifest segments are left alone, since migrating them would
+        change the ETags their manifests expect.
+        """
+        container = req.split_path(4, 4, True)[2]
+        if resp.status_int != 200 or req.range or \
+                req.environ.get('swift.source') in \
+                (MIGRATE_SOURCE,) + MANIFEST_SOURCES or \
+                any(fnmatch.fnmatchcase(container, pattern)
+                    for pattern in self.migrate_exclude_containers) or \
+                'X-Object-Manifest' in resp.headers or \
+                'X-Static-Large-Object' in resp.headers or \
+                resp.content_length is None or \
+                resp.content_length > self.migrate_max_size or \
+                req.path in self.migrating:
+            return
+        now = time.time()
+        if now < self.next_migration:
+            return
+        self.next_migration = now + self.migrate_interval
+        self.migrating.add(req.path)
+        spawn_n(self.migrate_object, dict(req.environ), req.path)
+
+    @staticmethod
+    def authorize_internally(subreq):
+        """
+        Let a migration subrequest through regardless of who read the object.
+
+        ``make_subrequest`` copies the reader's ``swift.authorize``, and the
+        reader may only have read access.
+        """
+        subreq.environ['swift.authorize'] = lambda req: None
+        subreq.environ['swift.authorize_override'] = True
+
+    def migrate_object(self, env, path):
+        """Re-read a legacy object and PUT it back through this middleware."""
+        get_resp = None
+        try:
+            get_req = wsgi.make_subrequest(
+                env, 'GET', path, agent='%(orig)s EncryptionMigrate',
+                swift_source=MIGRATE_SOURCE)
+            self.authorize_internally(get_req)
+            get_resp = get_req.get_response(self.app)
+            if get_resp.status_int != 200 or \
+                    SYSMETA_ENCRYPTION in get_resp.headers or \
+                    'X-Timestamp' not in get_resp.headers:
+                return
+
+            headers = dict(
+                (k, v) for k, v in get_resp.headers.items()
+                if k.title() in MIGRATE_COPY_HEADERS or
+                k.lower().startswith(('x-object-meta-', 'x-object-sysmeta-')))
+            headers['X-Timestamp'] = normalize_timestamp(
+                float(get_resp.headers['X-Timestamp']) + 0.00001)
+            put_req = wsgi.make_subrequest(
+                env, 'PUT', path, headers=headers,
+                agent='%(orig)s EncryptionMigrate',
+                swift_source=MIGRATE_SOURCE)
+            self.authorize_internally(put_req)
+            put_req.environ['encryption_params'] = env['encryption_params']
+            put_req.environ['wsgi.input'] = FileLikeIter(get_resp.app_iter)
+            put_req.content_length = get_resp.content_length
+            put_resp = put_req.get_response(self)
+            if put_resp.is_success:
+                self.logger.increment('migrate.success')
+            else:
+                self.logger.increment('migrate.failure')
+                self.logger.info('encryption: migrating %s got %s'
+                                 % (path, put_resp.status))
+        except Exception:
+            self.logger.increment('migrate.failure')
+            self.logger.exception('encryption: error migrating %s' % path)
+        finally:
+            if get_resp is not None:
+                close_if_possible(get_resp.app_iter)
+            self.migrating.discard(path)
+
+    def request_size(self, req):
+        """Size of the request's body (PUT) or range (GET), if known."""
+        if req.method == 'PUT':
+            return req.content_length
+        if req.range and len(req.range.ranges) == 1:
+            start, end = req.range.ranges[0]
+            if start is not None and end is not None:
+                return end - start + 1
+        return None
+
+    @property
+    def is_ctr(self):
+        return self.cipher_mode == getattr(self.cipher_class, 'MODE_CTR', None)
+
+    def new_cipher(self, key, iv, offset=0):
+        """
+        Build a cipher object for ``key`` and ``iv``.
+
+        In CTR mode the IV is taken as the initial (big-endian) counter value,
+        and the cipher can start ``offset`` bytes into the keystream, so that
+        a range of an object can be decrypted on its own.  Other modes must
+        start at offset 0.
+        """
+        if self.is_ctr:
+            block_size = self.cipher_class.block_size
+            bits = block_size * 8
+            initial = int(iv.encode('hex'), 16) if iv else 0
+            counter = Counter.new(
+                bits, allow_wraparound=True,
+                initial_value=(initial + offset // block_size) % (1 << bits))
+            cipher = self.cipher_class.new(key, self.cipher_mode,
+                                           counter=counter)
+            cipher.decrypt('\0' * (offset % block_size))
+            return cipher
+        if offset:
+            raise ValueError('%s cannot start mid-stream' % self.marker)
+        if iv is None:
+            return self.cipher_class.new(key, self.cipher_mode)
+        return self.cipher_class.new(key, self.cipher_mode, iv)
+
+    def response_cipher(self, req, resp):
+        """
+        Build the cipher which decrypts the body of a successful GET.
+
+        :raises HTTPInternalServerError: if the object was encrypted with a
+                                         different cipher or mode, or its
+                                         segment sysmeta is unusable
+        """
+        marker = resp.headers[SYSMETA_ENCRYPTION]
+        if marker != self.marker:
+            self.logger.error('encryption: %s was stored with %s, but this '
+                              'proxy is configured for %s'
+                              % (req.path, marker, self.marker))
+            raise swob.HTTPInternalServerError(
+                'encryption: object encrypted with a different cipher')
+        version, account, container, obj = req.split_path(4, 4, True)
+        try:
+            segment = segment_identity(resp.headers, account,
+                                       SYSMETA_SEGMENT_OF,
+                                       SYSMETA_SEGMENT_INDEX)
+        except swob.HTTPException:
+            self.logger.error('encryption: bad segment sysmeta on %s'
+                              % req.path)
+            raise swob.HTTPInternalServerError(
+                'encryption: bad segment sysmeta')
+        key, iv = self.get_secrets(req)
+        if segment:
+            key, iv = derive_segment_secrets(
+                key, iv, '/%s/%s/%s' % (account, container, obj), *segment)
+        offset = 0
+        if resp.status_int == 206:
+            # Content-Range: bytes <first>-<last>/<length>
+            offset = int(resp.headers['Content-Range'].split(
+                ' ', 1)[1].split('-', 1)[0])
+        return self.new_cipher(key, iv, offset)
+
+    def get_secrets(self, req):
+        """
+        Return ``(key, iv)`` for an object request.
+
+        Members of a bulk archive extraction share one batch per transaction,
+        so the key-management middleware is consulted once per archive rather
+        than once per member whenever it offers a ``batch_secret_generator``.
+        """
+        params = req.environ['encryption_params']
+        trans_id = req.environ.get('swift.trans_id')
+        if req.environ.get('swift.source') != BULK_EXTRACT_SOURCE or \
+                not trans_id or 'batch_secret_generator' not in params:
+            return parse_secrets(params['secret_generator'](req))
+
+        member_secrets = self.key_batches.get(trans_id)
+        if member_secrets is None:
+            member_secrets = params['batch_secret_generator'](req)
+            self.key_batches.put(trans_id, member_secrets)
+        return parse_secrets(member_secrets(req))
 
     @wsgify
     def __call__(self, req):
@@ -131,22 +680,68 @@ class EncryptionMiddleware(object):
             raise swob.HTTPServiceUnavailable(
                 'At-rest encryption improperly configured')
 
-        params = req.environ['encryption_params']
-        secrets = params['secret_generator'](req)
-        if type(secrets) is tuple and len(secrets) == 2:
-            key, iv = secrets
-        elif type(secrets) is bytes:
-            key, iv = secrets, None
-        else:
-            raise swob.HTTPInternalServerError(
-                'encryption: secrets() returned unexpected value')
+        if req.method == 'GET' and 'Range' in req.headers and \
+                not (self.is_ctr and req.range and
+                     len(req.range.ranges) == 1):
+            # Only a single CTR range can be decrypted in isolation; serve
+            # the whole object instead, which HTTP allows.
+            del req.headers['Range']
 
-        # TODO:
-        #  * pad input to block length if necessary
-        #  * deal with offsets in range requests
-        cipher = self.cipher_class.new(key, self.cipher_mode, iv=iv)
-        env['wsgi.input'] = (cipher.encrypt(i) for i in env['wsgi.input'])
-        return self.app(env, start_response)
+        size = self.request_size(req)
+        small = size is not None and size <= self.small_request_size
+        nbytes = self.crypto_chunk_size if size is None \
+            else min(self.crypto_chunk_size, size)
+        if not self.budget.acquire(nbytes, small):
+            raise swob.HTTPServiceUnavailable(
+                'At-rest encryption busy',
+                headers={'Retry-After': str(self.shed_retry_after)})
+
+        try:
+            # TODO:
+            #  * pad input to block length if necessary
+            if req.method == 'PUT':
+                key, iv = self.get_secrets(req)
+                req.headers[SYSMETA_ENCRYPTION] = self.marker
+                # Server-side copies carry the source's sysmeta; only the
+                # client's own segment headers may mark this PUT a segment.
+                req.headers.pop(SYSMETA_SEGMENT_OF, None)
+                req.headers.pop(SYSMETA_SEGMENT_INDEX, None)
+                segment = segment_identity(req.headers, account,
+                                           SEGMENT_OF_HEADER,
+                                           SEGMENT_INDEX_HEADER)
+                if segment:
+                    key, iv = derive_segment_secrets(
+                        key, iv, '/%s/%s/%s' % (account, container, obj),
+                        *segment)
+                    req.headers[SYSMETA_SEGMENT_OF] = \
+                        req.headers.pop(SEGMENT_OF_HEADER)
+                    req.headers[SYSMETA_SEGMENT_INDEX] = \
+                        req.headers.pop(SEGMENT_INDEX_HEADER)
+                cipher = self.new_cipher(key, iv)
+                req.environ['wsgi.input'] = EncryptingInput(
+                    req.environ['wsgi.input'], cipher)
+                resp = req.get_response(self.app)
+            else:
+                resp = req.get_response(self.app)
+                if resp.is_success and SYSMETA_ENCRYPTION not in resp.headers:
+                    # Legacy plaintext object: no cipher work at all
+                    self.budget.release(nbytes)
+                    if self.migrate_on_read:
+                        self.maybe_migrate(req, resp)
+                    return resp
+                if resp.is_success:
+                    try:
+                        cipher = self.response_cipher(req, resp)
+                    except Exception:
+                        close_if_possible(resp.app_iter)
+                        raise
+                    resp.app_iter = DecryptingIter(resp.app_iter, cipher)
+        except Exception:
+            self.budget.release(nbytes)
+            raise
+        resp.app_iter = ReleasingIter(
+            resp.app_iter, lambda: self.budget.release(nbytes))
+        return resp
 
 
 def filter_factory(global_conf, **local_conf):
@@ -154,5 +749,17 @@ def filter_factory(global_conf, **local_conf):
     conf = dict(global_conf, **local_conf)
     conf.setdefault('cipher_name', 'AES')
     conf.setdefault('cipher_mode', 'CTR')
+    conf.setdefault('bulk_batch_ttl', '300')
+    conf.setdefault('bulk_max_batches', '1024')
+    conf.setdefault('max_crypto_bytes', '0')
+    conf.setdefault('max_cipher_streams', '0')
+    conf.setdefault('reserved_small_streams', '0')
+    conf.setdefault('small_request_size', '1048576')
+    conf.setdefault('crypto_chunk_size', '65536')
+    conf.setdefault('shed_retry_after', '1')
+    conf.setdefault('migrate_on_read', 'false')
+    conf.setdefault('migrate_rate', '1')
+    conf.setdefault('migrate_max_size', '104857600')
+    conf.setdefault('migrate_exclude_containers', '*_segments')
     register_swift_info('encryption', conf)
     return lambda app: EncryptionMiddleware(app, conf)
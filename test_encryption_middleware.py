@@ -0,0 +1,605 @@
+#!/usr/bin/python
+
+import unittest
+import mock
+import encryption
+
+from swift.common import swob
+
+
+KEY, IV = 'k' * 16, 'i' * 16
+
+
+class FakeApp(object):
+    """Stand-in for the proxy server; records requests and their bodies."""
+
+    def __init__(self, status='201 Created', headers=None, body=''):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self.calls = []
+
+    def __call__(self, env, start_response):
+        req = swob.Request(env)
+        body = req.body_file.read() if req.method == 'PUT' else None
+        self.calls.append((req, body))
+        start_response(self.status, self.headers.items())
+        return [self.body]
+
+
+class FakeStore(object):
+    """Stand-in for the proxy server which stores bodies and sysmeta."""
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def __call__(self, env, start_response):
+        req = swob.Request(env)
+        self.calls.append(req)
+        # Like the proxy server, defer to the auth middleware's callback
+        denial = env.get('swift.authorize', lambda req: None)(req)
+        if denial:
+            return denial(env, start_response)
+        if req.method == 'PUT':
+            headers = dict((k, v) for k, v in req.headers.items()
+                           if k.lower().startswith('x-object-sysmeta-'))
+            self.objects[req.path] = (headers, req.body_file.read())
+            resp = swob.HTTPCreated()
+        elif req.path in self.objects:
+            headers, body = self.objects[req.path]
+            resp = swob.Response(body=body, headers=headers, request=req,
+                                 conditional_response=True)
+        else:
+            resp = swob.HTTPNotFound()
+        return resp(env, start_response)
+
+
+def make_ware(app=None, **conf):
+    with mock.patch('encryption.get_logger') as get_logger:
+        ware = encryption.EncryptionMiddleware(app or FakeApp(), conf)
+    ware.logger = ware.budget.logger = get_logger.return_value
+    return ware
+
+
+def make_req(path='/v1/a/c/o', method='PUT', body='plaintext', params=None,
+             **environ):
+    req = swob.Request.blank(path, environ={'REQUEST_METHOD': method},
+                             body=body if method == 'PUT' else None)
+    if params is None:
+        params = {'secret_generator': mock.Mock(return_value=(KEY, IV))}
+    req.environ['encryption_params'] = params
+    req.environ.update(environ)
+    return req
+
+
+class KeyBatchCacheTest(unittest.TestCase):
+    def test_get_put_expiry(self):
+        cache = encryption.KeyBatchCache(ttl=10, max_batches=2)
+        self.assertIsNone(cache.get('tx1', now=0))
+        cache.put('tx1', 'gen1', now=0)
+        self.assertEqual('gen1', cache.get('tx1', now=5))
+        # get() refreshed the expiry to 15
+        self.assertEqual('gen1', cache.get('tx1', now=14))
+        self.assertIsNone(cache.get('tx1', now=30))
+
+    def test_eviction(self):
+        cache = encryption.KeyBatchCache(ttl=10, max_batches=2)
+        cache.put('tx1', 'gen1', now=0)
+        cache.put('tx2', 'gen2', now=1)
+        cache.put('tx3', 'gen3', now=2)
+        self.assertIsNone(cache.get('tx1', now=3))
+        self.assertEqual('gen2', cache.get('tx2', now=3))
+        self.assertEqual('gen3', cache.get('tx3', now=3))
+
+
+class CryptoBudgetTest(unittest.TestCase):
+    def test_limits(self):
+        budget = encryption.CryptoBudget(max_bytes=100, max_streams=3,
+                                         reserved_small_streams=1,
+                                         logger=mock.Mock())
+        self.assertTrue(budget.acquire(40, small=False))
+        self.assertTrue(budget.acquire(40, small=False))
+        # The last stream is reserved for small requests
+        self.assertFalse(budget.acquire(10, small=False))
+        # Byte budget applies to small requests too
+        self.assertFalse(budget.acquire(30, small=True))
+        self.assertTrue(budget.acquire(20, small=True))
+        self.assertEqual(3, budget.streams)
+        self.assertEqual(100, budget.bytes_in_flight)
+        budget.release(40)
+        self.assertEqual(2, budget.streams)
+        self.assertEqual(60, budget.bytes_in_flight)
+        self.assertEqual([mock.call('budget.shed')] * 2,
+                         budget.logger.increment.mock_calls)
+        # Usage is reported as absolute values, never as deltas
+        self.assertEqual([mock.call('budget.streams', 2),
+                          mock.call('budget.bytes', 60)],
+                         budget.logger.timing.mock_calls[-2:])
+        self.assertEqual([mock.call('budget.streams', n)
+                          for n in (1, 2, 3, 2)],
+                         [c for c in budget.logger.timing.mock_calls
+                          if c[1][0] == 'budget.streams'])
+        self.assertFalse(budget.logger.update_stats.called)
+
+    def test_releasing_iter(self):
+        release = mock.Mock()
+        body = encryption.ReleasingIter(['a', 'b'], release)
+        self.assertEqual('ab', ''.join(body))
+        body.close()
+        self.assertEqual([mock.call()], release.mock_calls)
+
+
+class RangeGetTest(unittest.TestCase):
+    body = ''.join(chr(i % 251) for i in range(1000))
+
+    def setUp(self):
+        self.ware = make_ware(FakeStore())
+        make_req(body=self.body).get_response(self.ware)
+
+    def get(self, range_header):
+        req = make_req(method='GET')
+        req.headers['Range'] = range_header
+        return req.get_response(self.ware)
+
+    def test_single_ranges(self):
+        for range_header, expected in (('bytes=0-99', self.body[:100]),
+                                       ('bytes=37-530', self.body[37:531]),
+                                       ('bytes=-21', self.body[-21:]),
+                                       ('bytes=990-', self.body[990:])):
+            resp = self.get(range_header)
+            self.assertEqual(206, resp.status_int)
+            self.assertEqual(expected, resp.body)
+
+    def test_multiple_ranges_get_whole_object(self):
+        resp = self.get('bytes=0-1,5-6')
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual(self.body, resp.body)
+        self.assertNotIn('Range', self.ware.app.calls[-1].headers)
+
+    def test_non_ctr_mode_gets_whole_object(self):
+        ware = make_ware(FakeStore(), cipher_mode='CFB')
+        make_req(body=self.body).get_response(ware)
+        req = make_req(method='GET')
+        req.headers['Range'] = 'bytes=10-19'
+        resp = req.get_response(ware)
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual(self.body, resp.body)
+
+
+class SegmentRequestTest(unittest.TestCase):
+    def put_segment(self, ware, path, body, index):
+        req = make_req(path, body=body)
+        req.headers[encryption.SEGMENT_OF_HEADER] = 'c/manifest'
+        req.headers[encryption.SEGMENT_INDEX_HEADER] = str(index)
+        return req.get_response(ware)
+
+    def test_segment_round_trip(self):
+        ware = make_ware(FakeStore())
+        self.put_segment(ware, '/v1/a/segs/0', 'first segment', 0)
+        self.put_segment(ware, '/v1/a/segs/1', 'first segment', 1)
+        headers, stored0 = ware.app.objects['/v1/a/segs/0']
+        self.assertEqual({
+            encryption.SYSMETA_ENCRYPTION: 'AES/CTR',
+            encryption.SYSMETA_SEGMENT_OF: 'c/manifest',
+            encryption.SYSMETA_SEGMENT_INDEX: '0',
+        }, headers)
+        # Same plaintext and secrets, different keystreams
+        self.assertNotEqual(stored0, ware.app.objects['/v1/a/segs/1'][1])
+        for path in ('/v1/a/segs/0', '/v1/a/segs/1'):
+            resp = make_req(path, method='GET').get_response(ware)
+            self.assertEqual('first segment', resp.body)
+        req = make_req('/v1/a/segs/1', method='GET')
+        req.headers['Range'] = 'bytes=6-'
+        self.assertEqual('segment', req.get_response(ware).body)
+
+    def test_copied_segment_round_trip(self):
+        ware = make_ware(FakeStore())
+        self.put_segment(ware, '/v1/a/segs/0', 'segment data', 0)
+        # The copy middleware GETs the source and PUTs its body and sysmeta
+        # to the destination, without the client's segment headers.
+        source = make_req('/v1/a/segs/0', method='GET').get_response(ware)
+        copy = make_req('/v1/a/c/copy', body=source.body)
+        copy.headers.update(
+            (k, v) for k, v in source.headers.items()
+            if k.lower().startswith('x-object-sysmeta-'))
+        self.assertIn(encryption.SYSMETA_SEGMENT_OF, copy.headers)
+        self.assertEqual(201, copy.get_response(ware).status_int)
+
+        headers, stored = ware.app.objects['/v1/a/c/copy']
+        self.assertNotIn(encryption.SYSMETA_SEGMENT_OF, headers)
+        self.assertNotIn(encryption.SYSMETA_SEGMENT_INDEX, headers)
+        self.assertEqual('segment data', make_req(
+            '/v1/a/c/copy', method='GET').get_response(ware).body)
+
+    def test_shared_secrets_different_segment_paths(self):
+        ware = make_ware(FakeStore())
+        self.put_segment(ware, '/v1/a/segs/x', 'same plaintext', 0)
+        self.put_segment(ware, '/v1/a/segs/y', 'same plaintext', 0)
+        self.assertNotEqual(ware.app.objects['/v1/a/segs/x'][1],
+                            ware.app.objects['/v1/a/segs/y'][1])
+
+    def test_bad_client_headers(self):
+        ware = make_ware(FakeStore())
+        req = make_req('/v1/a/segs/0')
+        req.headers[encryption.SEGMENT_INDEX_HEADER] = '0'
+        self.assertEqual(400, req.get_response(ware).status_int)
+        self.assertEqual(0, ware.budget.streams)
+
+    def test_corrupt_sysmeta_is_server_error(self):
+        ware = make_ware(FakeApp(status='200 OK', body='ciphertext', headers={
+            encryption.SYSMETA_ENCRYPTION: 'AES/CTR',
+            encryption.SYSMETA_SEGMENT_OF: 'c/manifest',
+            encryption.SYSMETA_SEGMENT_INDEX: 'junk'}))
+        with mock.patch('encryption.close_if_possible') as close:
+            resp = make_req(method='GET').get_response(ware)
+        self.assertEqual(500, resp.status_int)
+        self.assertEqual(1, close.call_count)
+        self.assertEqual(0, ware.budget.streams)
+        self.assertTrue(ware.logger.error.called)
+
+
+class AdmissionControlTest(unittest.TestCase):
+    def test_request_size(self):
+        ware = make_ware()
+        self.assertEqual(9, ware.request_size(make_req(body='plaintext')))
+        req = make_req(method='GET')
+        self.assertIsNone(ware.request_size(req))
+        req.headers['Range'] = 'bytes=10-19'
+        self.assertEqual(10, ware.request_size(req))
+        req.headers['Range'] = 'bytes=-10'
+        self.assertIsNone(ware.request_size(req))
+        req.headers['Range'] = 'bytes=0-1,5-6'
+        self.assertIsNone(ware.request_size(req))
+
+    def test_byte_budget_must_fit_a_chunk(self):
+        self.assertRaises(ValueError, make_ware, max_crypto_bytes='1000',
+                          crypto_chunk_size='4096')
+        make_ware(max_crypto_bytes='4096', crypto_chunk_size='4096')
+        make_ware(max_crypto_bytes='0', crypto_chunk_size='4096')
+
+    def test_shed_with_retry_after(self):
+        ware = make_ware(max_cipher_streams='1', shed_retry_after='7')
+        held = make_req().get_response(ware)
+        self.assertEqual(1, ware.budget.streams)
+        self.assertEqual(9, ware.budget.bytes_in_flight)
+
+        resp = make_req().get_response(ware)
+        self.assertEqual(503, resp.status_int)
+        self.assertEqual('7', resp.headers['Retry-After'])
+        self.assertEqual(1, len(ware.app.calls))
+        ware.logger.increment.assert_called_once_with('budget.shed')
+
+        # Closing the held response body frees its stream
+        held.app_iter.close()
+        self.assertEqual(0, ware.budget.streams)
+        self.assertEqual(0, ware.budget.bytes_in_flight)
+        self.assertEqual(201, make_req().get_response(ware).status_int)
+
+    def test_small_requests_keep_reserved_streams(self):
+        ware = make_ware(max_cipher_streams='2', reserved_small_streams='1',
+                         small_request_size='4')
+        held = make_req(body='large body').get_response(ware)
+        self.assertEqual(201, held.status_int)
+        self.assertEqual(503, make_req(body='large body').get_response(
+            ware).status_int)
+        self.assertEqual(201, make_req(body='tiny').get_response(
+            ware).status_int)
+
+    def test_release_on_exception(self):
+        ware = make_ware(mock.Mock(side_effect=ValueError('boom')),
+                         max_cipher_streams='1')
+        with self.assertRaises(ValueError):
+            make_req().get_response(ware)
+        self.assertEqual(0, ware.budget.streams)
+        self.assertEqual(0, ware.budget.bytes_in_flight)
+
+
+class SegmentSecretsTest(unittest.TestCase):
+    def test_derive_segment_secrets(self):
+        key, iv = 'k' * 32, 'i' * 16
+        derive = encryption.derive_segment_secrets
+        seg0 = derive(key, iv, '/a/c/s0', '/a/c/o', 0)
+        self.assertEqual(seg0, derive(key, iv, '/a/c/s0', '/a/c/o', 0))
+        self.assertEqual((32, 16), (len(seg0[0]), len(seg0[1])))
+        self.assertNotEqual(seg0, derive(key, iv, '/a/c/s0', '/a/c/o', 1))
+        self.assertNotEqual(seg0, derive(key, iv, '/a/c/s0', '/a/c/o2', 0))
+        # Same claimed manifest and index, different segment object
+        self.assertNotEqual(seg0, derive(key, iv, '/a/c/s1', '/a/c/o', 0))
+        self.assertNotEqual(seg0[0], key)
+        self.assertIsNone(derive(key, None, '/a/c/s0', '/a/c/o', 0)[1])
+        # Keys longer than one HMAC-SHA256 block still get fully derived
+        self.assertEqual(56, len(derive('k' * 56, iv, '/a/c/s0', '/a/c/o',
+                                        0)[0]))
+
+    def test_segment_identity(self):
+        ident = encryption.segment_identity
+        of_hdr = encryption.SEGMENT_OF_HEADER
+        idx_hdr = encryption.SEGMENT_INDEX_HEADER
+        self.assertIsNone(ident({}, 'a', of_hdr, idx_hdr))
+        self.assertEqual(('/a/c/o', 3), ident(
+            {of_hdr: 'c/o', idx_hdr: '3'}, 'a', of_hdr, idx_hdr))
+        for bad in ({of_hdr: 'c/o'}, {idx_hdr: '3'},
+                    {of_hdr: 'c/o', idx_hdr: '-1'},
+                    {of_hdr: 'c/o', idx_hdr: 'x'}):
+            with self.assertRaises(swob.HTTPException) as cm:
+                ident(bad, 'a', of_hdr, idx_hdr)
+            self.assertEqual('400 Bad Request', cm.exception.status)
+
+
+class GetSecretsTest(unittest.TestCase):
+    def setUp(self):
+        self.ware = make_ware()
+        self.member_secrets = mock.Mock(return_value=(KEY, IV))
+        self.params = {
+            'secret_generator': mock.Mock(return_value=(KEY, IV)),
+            'batch_secret_generator': mock.Mock(
+                return_value=self.member_secrets),
+        }
+
+    def member_req(self, trans_id, name='o'):
+        return make_req('/v1/a/c/%s' % name, params=self.params,
+                        **{'swift.source': 'EA', 'swift.trans_id': trans_id})
+
+    def test_batch_per_transaction(self):
+        for trans_id, name in (('tx1', 'o1'), ('tx1', 'o2'), ('tx1', 'o3'),
+                               ('tx2', 'o4')):
+            self.assertEqual((KEY, IV), self.ware.get_secrets(
+                self.member_req(trans_id, name)))
+        self.assertEqual(2, self.params['batch_secret_generator'].call_count)
+        self.assertEqual(4, self.member_secrets.call_count)
+        self.assertEqual(['/v1/a/c/o%d' % i for i in range(1, 5)],
+                         [c[0][0].path for c in
+                          self.member_secrets.call_args_list])
+        self.assertFalse(self.params['secret_generator'].called)
+
+    def test_fallback_to_secret_generator(self):
+        # Not a bulk extract member
+        self.ware.get_secrets(make_req(params=self.params,
+                                       **{'swift.trans_id': 'tx1'}))
+        # Bulk extract member, but no batch generator available
+        del self.params['batch_secret_generator']
+        self.ware.get_secrets(self.member_req('tx1'))
+        self.assertEqual(2, self.params['secret_generator'].call_count)
+        self.assertFalse(self.member_secrets.called)
+
+    def test_bare_key_and_bad_value(self):
+        self.params['secret_generator'].return_value = KEY
+        self.assertEqual((KEY, None), self.ware.get_secrets(
+            make_req(params=self.params)))
+        self.params['secret_generator'].return_value = ['junk']
+        with self.assertRaises(swob.HTTPException) as cm:
+            self.ware.get_secrets(make_req(params=self.params))
+        self.assertEqual(500, cm.exception.status_int)
+
+
+class MiddlewareCallTest(unittest.TestCase):
+    def test_put_encrypts_body(self):
+        ware = make_ware()
+        resp = make_req(body='plaintext').get_response(ware)
+        self.assertEqual(201, resp.status_int)
+        stored = ware.app.calls[0][1]
+        self.assertNotEqual('plaintext', stored)
+        self.assertEqual('plaintext', ware.new_cipher(KEY, IV).decrypt(stored))
+
+    def test_bulk_members_share_batch(self):
+        ware = make_ware()
+        member_secrets = mock.Mock(return_value=(KEY, IV))
+        params = {'secret_generator': mock.Mock(),
+                  'batch_secret_generator': mock.Mock(
+                      return_value=member_secrets)}
+        for name in ('o1', 'o2', 'o3'):
+            resp = make_req('/v1/a/c/%s' % name, params=params, **{
+                'swift.source': 'EA', 'swift.trans_id': 'tx1',
+            }).get_response(ware)
+            self.assertEqual(201, resp.status_int)
+        self.assertEqual(1, params['batch_secret_generator'].call_count)
+        self.assertEqual(3, member_secrets.call_count)
+        self.assertFalse(params['secret_generator'].called)
+
+    def test_passthrough_and_misconfiguration(self):
+        ware = make_ware()
+        for req in (make_req(method='POST'), make_req('/v1/a/c')):
+            req.environ['encryption_params']['secret_generator'].side_effect \
+                = AssertionError('key manager should not be called')
+            self.assertEqual(201, req.get_response(ware).status_int)
+        req = make_req()
+        del req.environ['encryption_params']
+        self.assertEqual(503, req.get_response(ware).status_int)
+        self.assertEqual(2, len(ware.app.calls))
+
+
+class LegacyObjectTest(unittest.TestCase):
+    legacy_headers = {
+        'X-Timestamp': '1400000000.00000',
+        'Content-Type': 'text/plain',
+        'X-Object-Meta-Color': 'blue',
+        'X-Object-Sysmeta-Other': 'kept',
+        'X-Backend-Junk': 'dropped',
+    }
+
+    def setUp(self):
+        self.ware = make_ware(FakeStore(), migrate_on_read='true')
+        self.ware.app.objects['/v1/a/c/o'] = (dict(self.legacy_headers),
+                                              'legacy body')
+
+    def test_put_sets_marker(self):
+        make_req('/v1/a/c/new').get_response(self.ware)
+        headers, body = self.ware.app.objects['/v1/a/c/new']
+        self.assertEqual('AES/CTR', headers[encryption.SYSMETA_ENCRYPTION])
+
+    def test_legacy_get_passes_through(self):
+        req = make_req(method='GET')
+        secret_generator = req.environ['encryption_params'][
+            'secret_generator']
+        with mock.patch.object(self.ware, 'new_cipher') as new_cipher, \
+                mock.patch('encryption.spawn_n'):
+            resp = req.get_response(self.ware)
+            # Budget is released before the body is even read
+            self.assertEqual(0, self.ware.budget.streams)
+            self.assertEqual(0, self.ware.budget.bytes_in_flight)
+            self.assertEqual('legacy body', resp.body)
+        self.assertFalse(secret_generator.called)
+        self.assertFalse(new_cipher.called)
+
+    def test_marker_mismatch_fails_loudly(self):
+        make_req('/v1/a/c/new').get_response(self.ware)
+        other = make_ware(self.ware.app, cipher_mode='CFB')
+        resp = make_req('/v1/a/c/new', method='GET').get_response(other)
+        self.assertEqual(500, resp.status_int)
+        self.assertTrue(other.logger.error.called)
+        self.assertEqual(0, other.budget.streams)
+
+    def test_migrate_rate(self):
+        ware = make_ware(migrate_on_read='true', migrate_rate='0')
+        self.assertFalse(ware.migrate_on_read)
+        ware = make_ware(migrate_on_read='true', migrate_rate='4')
+        self.assertTrue(ware.migrate_on_read)
+        self.assertEqual(0.25, ware.migrate_interval)
+        self.assertRaises(ValueError, make_ware, migrate_rate='-1')
+
+    def test_maybe_migrate_filters(self):
+        ware = make_ware(migrate_on_read='true', migrate_rate='1',
+                         migrate_max_size='100')
+
+        def attempt(now, req_headers=None, resp_headers=None, body='x' * 10,
+                    status=200, path='/v1/a/c/o', **environ):
+            req = make_req(path, method='GET', **environ)
+            req.headers.update(req_headers or {})
+            resp = swob.Response(status=status, body=body,
+                                 headers=resp_headers or {})
+            with mock.patch('encryption.spawn_n') as spawn_n, \
+                    mock.patch('time.time', return_value=now):
+                ware.maybe_migrate(req, resp)
+            return spawn_n.call_args_list
+
+        self.assertEqual([], attempt(100, {'Range': 'bytes=0-1'}))
+        self.assertEqual([], attempt(100, status=206))
+        self.assertEqual([], attempt(100, resp_headers={
+            'X-Static-Large-Object': 'True'}))
+        self.assertEqual([], attempt(100, resp_headers={
+            'X-Object-Manifest': 'c/seg_'}))
+        self.assertEqual([], attempt(100, body='x' * 101))
+        self.assertEqual([], attempt(100, **{
+            'swift.source': encryption.MIGRATE_SOURCE}))
+        # Segment reads by SLO/DLO, and likely segment containers
+        self.assertEqual([], attempt(100, **{'swift.source': 'SLO'}))
+        self.assertEqual([], attempt(100, **{'swift.source': 'DLO'}))
+        self.assertEqual([], attempt(100, path='/v1/a/c_segments/o'))
+
+        calls = attempt(100)
+        self.assertEqual(1, len(calls))
+        self.assertEqual('/v1/a/c/o', calls[0][0][2])
+        # Already migrating this path
+        self.assertEqual([], attempt(200))
+        ware.migrating.clear()
+        # Rate limited: next migration allowed one second later
+        self.assertEqual([], attempt(100.5))
+        self.assertEqual(1, len(attempt(101)))
+
+    def test_exclude_containers(self):
+        ware = make_ware(migrate_on_read='true',
+                         migrate_exclude_containers='segs, *-parts')
+        resp = swob.Response(status=200, body='x')
+        with mock.patch('encryption.spawn_n') as spawn_n:
+            for path in ('/v1/a/segs/o', '/v1/a/big-parts/o',
+                         '/v1/a/c_segments/o'):
+                ware.migrating.clear()
+                ware.next_migration = 0
+                ware.maybe_migrate(make_req(path, method='GET'), resp)
+        self.assertEqual(['/v1/a/c_segments/o'],
+                         [c[0][2] for c in spawn_n.call_args_list])
+
+    def test_legacy_slo_survives_segment_reads(self):
+        # A legacy SLO's segment is read whole by SLO, and directly by a
+        # client; neither read may re-encrypt it behind the manifest's back.
+        self.ware.app.objects['/v1/a/c_segments/0'] = (
+            dict(self.legacy_headers), 'legacy body')
+        with mock.patch('encryption.spawn_n',
+                        side_effect=lambda f, *a: f(*a)):
+            for environ in ({'swift.source': 'SLO'}, {}):
+                resp = make_req('/v1/a/c_segments/0', method='GET',
+                                **environ).get_response(self.ware)
+                self.assertEqual('legacy body', resp.body)
+        self.assertEqual('legacy body',
+                         self.ware.app.objects['/v1/a/c_segments/0'][1])
+        self.assertEqual(['GET', 'GET'],
+                         [r.method for r in self.ware.app.calls])
+        self.assertFalse(self.ware.logger.increment.called)
+
+    def test_migrate_object_success(self):
+        env = make_req(method='GET').environ
+        self.ware.migrating.add('/v1/a/c/o')
+        self.ware.migrate_object(env, '/v1/a/c/o')
+
+        put = self.ware.app.calls[-1]
+        self.assertEqual('PUT', put.method)
+        self.assertEqual(encryption.MIGRATE_SOURCE,
+                         put.environ['swift.source'])
+        self.assertEqual('1400000000.00001', put.headers['X-Timestamp'])
+        self.assertEqual('text/plain', put.headers['Content-Type'])
+        self.assertEqual('blue', put.headers['X-Object-Meta-Color'])
+        self.assertEqual('kept', put.headers['X-Object-Sysmeta-Other'])
+        self.assertNotIn('X-Backend-Junk', put.headers)
+
+        headers, stored = self.ware.app.objects['/v1/a/c/o']
+        self.assertEqual('AES/CTR', headers[encryption.SYSMETA_ENCRYPTION])
+        self.assertEqual('legacy body',
+                         self.ware.new_cipher(KEY, IV).decrypt(stored))
+        self.assertEqual('legacy body', make_req(method='GET').get_response(
+            self.ware).body)
+        self.ware.logger.increment.assert_called_once_with(
+            'migrate.success')
+        self.assertEqual(set(), self.ware.migrating)
+
+    def test_migrate_object_ignores_reader_authorization(self):
+        # Anonymous reader of a public container: reads allowed, writes not
+        def read_only(req):
+            if req.method != 'GET':
+                return swob.HTTPUnauthorized(request=req)
+
+        env = make_req(method='GET', **{'swift.authorize': read_only,
+                                        'REMOTE_USER': '.r:*'}).environ
+        self.ware.migrate_object(env, '/v1/a/c/o')
+
+        get, put = self.ware.app.calls
+        for subreq in (get, put):
+            self.assertTrue(subreq.environ['swift.authorize_override'])
+            self.assertIsNot(read_only, subreq.environ['swift.authorize'])
+        headers, stored = self.ware.app.objects['/v1/a/c/o']
+        self.assertEqual('AES/CTR', headers[encryption.SYSMETA_ENCRYPTION])
+        self.ware.logger.increment.assert_called_once_with(
+            'migrate.success')
+        # The reader's own environment is untouched
+        self.assertIs(read_only, env['swift.authorize'])
+
+    def test_migrate_object_skips_encrypted(self):
+        make_req().get_response(self.ware)
+        calls = len(self.ware.app.calls)
+        self.ware.migrate_object(make_req(method='GET').environ, '/v1/a/c/o')
+        self.assertEqual(calls + 1, len(self.ware.app.calls))
+        self.assertFalse(self.ware.logger.increment.called)
+
+    def test_migrate_object_put_failure_closes_get(self):
+        ware = make_ware(self.ware.app, max_cipher_streams='1')
+        held = make_req('/v1/a/c/other').get_response(ware)
+        with mock.patch('encryption.close_if_possible',
+                        wraps=encryption.close_if_possible) as close:
+            ware.migrate_object(make_req(method='GET').environ, '/v1/a/c/o')
+        self.assertTrue(close.called)
+        ware.logger.increment.assert_any_call('budget.shed')
+        ware.logger.increment.assert_called_with('migrate.failure')
+        self.assertEqual('legacy body', ware.app.objects['/v1/a/c/o'][1])
+        held.app_iter.close()
+
+    def test_migrate_object_exception(self):
+        self.ware.app = mock.Mock(side_effect=ValueError('boom'))
+        self.ware.migrating.add('/v1/a/c/o')
+        self.ware.migrate_object(make_req(method='GET').environ, '/v1/a/c/o')
+        self.ware.logger.increment.assert_called_once_with('migrate.failure')
+        self.assertTrue(self.ware.logger.exception.called)
+        self.assertEqual(set(), self.ware.migrating)
+
+
+if __name__ == '__main__':
+    unittest.main()